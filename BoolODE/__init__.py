@@ -84,6 +84,16 @@ class BoolODE(object):
             data['sample_cells'] = job.get('sample_cells',False)
             data['nClusters'] = job.get('nClusters',1)
             data['doParallel'] = job.get('do_parallel',False)            
+            data['doBatch'] = job.get('do_batch',False)
+            data['deterministic'] = job.get('deterministic',False)
+            if data['deterministic'] and data['doBatch']:
+                print("do_batch only supports stochastic simulations, ignoring it")
+                data['doBatch'] = False
+            data['write_csv'] = job.get('write_csv',True)
+            data['output_format'] = job.get('output_format','csv')
+            if data['output_format'] not in ['csv', 'parquet', 'feather']:
+                print("Unknown output_format %s, using csv" % data['output_format'])
+                data['output_format'] = 'csv'
             data['identical_pars'] = job.get('identical_pars',False)
             data['sample_pars'] = job.get('sample_pars',False)
             data['sample_std'] = job.get('sample_std',0.1)
@@ -193,6 +203,12 @@ class BoolODE(object):
                 gensample_jobs = self.post_settings.gensample_jobs
             for gsamp in gensample_jobs:
                 for jobid in alljobs:
+                    if not self.jobs[jobid]['write_csv']:
+                        ## genSamples() reads the files in /simulations/
+                        print("Skipping post processing of job %s, as write_csv is False"\
+                              % self.jobs[jobid]['name'])
+                        generatedPaths[jobid] = []
+                        continue
                     settings = {}
                     settings['num_cells'] = self.jobs[jobid]['num_cells']
                     settings['sample_size'] = gsamp.get('sample_size', 100)
@@ -200,6 +216,7 @@ class BoolODE(object):
                     settings['nDatasets'] = gsamp.get('nDatasets', 1)
                     settings['name'] = self.jobs[jobid]['name']
                     settings['nClusters'] = self.jobs[jobid]['nClusters']
+                    settings['output_format'] = self.jobs[jobid]['output_format']
                     generatedPaths[jobid] = po.genSamples(settings)
         
         if self.post_settings.dropout_jobs is not None:
@@ -21,6 +21,30 @@ from typing import Dict, List
 from BoolODE import utils
 from BoolODE import simulator 
 from importlib.machinery import SourceFileLoader
+try:
+    import sympy
+    from sympy.printing.pycode import PythonCodePrinter
+except ImportError:
+    sympy = None
+
+if sympy is not None:
+    class HillPower(sympy.Function):
+        """
+        Power with a symbolic exponent, (p/k)^n in the Hill functions.
+        sympy differentiates b**n as n*b**n/b, which is undefined
+        when the regulator is 0. HillPower is differentiated as
+        n*b**(n-1) instead.
+        """
+        def fdiff(self, argindex=1):
+            base, exponent = self.args
+            return exponent*HillPower(base, exponent - 1)
+
+    class JacobianPrinter(PythonCodePrinter):
+        """
+        Prints the entries of the Jacobian as python expressions.
+        """
+        def _print_HillPower(self, expr):
+            return '(' + self._print(expr.args[0]) + ')**(' + self._print(expr.args[1]) + ')'
 
 class GenerateModel:
     """Class that holds model attributes. Provides helper functions to convert a Boolean model
@@ -56,6 +80,8 @@ class GenerateModel:
         self.allnodes = set()
         self.varspecs = dict()
         self.varmapper = dict()
+        self.rnaIndex = np.array([], dtype=np.int32)
+        self.proteinIndex = np.array([], dtype=np.int32)
         self.par = dict()
         self.parmapper = dict()
         self.kineticParameterDefaults = dict()
@@ -545,7 +571,7 @@ class GenerateModel:
                 # regulatory terms
                 exponent += ')'
                 maxexp = '10.' # '100'
-                f = '(1./(1. + np.exp(np.sign('+exponent+')*min(' +maxexp +',abs(' + exponent+ ')))))'
+                f = '(1./(1. + np.exp(np.sign('+exponent+')*np.minimum(' +maxexp +',np.abs(' + exponent+ ')))))'
             
             if currgene in self.proteinlist:
                 Production =  f
@@ -579,6 +605,11 @@ class GenerateModel:
         self.ModelSpec['ics'] = ics
         
         self.varmapper = {i:var for i,var in enumerate(self.ModelSpec['varspecs'].keys())}
+        # Indices of the mRNA and protein variables in the state vector
+        self.rnaIndex = np.array([i for i,var in self.varmapper.items() if var.startswith('x_')],
+                                 dtype=np.int32)
+        self.proteinIndex = np.array([i for i,var in self.varmapper.items() if var.startswith('p_')],
+                                     dtype=np.int32)
         self.parmapper = {i:par for i,par in enumerate(self.ModelSpec['pars'].keys())}
 
     def writeModelToFile(self):
@@ -618,6 +649,53 @@ class GenerateModel:
             out.write('    dY = np.array([' + outstr+ '])\n')
             out.write('    return(dY)\n')
             out.write('#####################################################')
+            if self.settings['deterministic'] and sympy is not None\
+               and self.settings['modeltype'] == 'hill':
+                self.writeJacobianToFile(out, par_names)
+
+    def writeJacobianToFile(self, out, par_names):
+        """
+        Writes the Jacobian of the ODE model to the model file as a python
+        function called Jacobian(), which takes the same arguments as Model().
+        The derivatives are computed symbolically using sympy, and only
+        the nonzero entries are written.
+        The Jacobian is used by the stiff solver in simulator.simulateModel()
+        for deterministic simulations.
+
+        :param out: The open model file
+        :type out: file
+        :param par_names: Sorted list of parameter names, as written in Model()
+        :type par_names: list
+        """
+        numVars = len(self.varmapper.keys())
+        symbols = {p:sympy.Symbol(p) for p in par_names}
+        variables = [sympy.Symbol(self.varmapper[i]) for i in range(numVars)]
+        symbols.update({str(v):v for v in variables})
+        printer = JacobianPrinter()
+        
+        out.write('\n')
+        out.write('def Jacobian(Y,t,pars):\n')
+        out.write('    # Parameters\n')
+        for i,p in enumerate(par_names):
+            out.write('    ' + p + ' = pars[' + str(i) + ']\n')
+        out.write('    # Variables\n')
+        for i in range(numVars):
+            out.write('    ' + self.varmapper[i] + ' = Y[' + str(i) + ']\n')
+        out.write('    J = np.zeros((' + str(numVars) + ',' + str(numVars) + '))\n')
+        for i in range(numVars):
+            vdef = sympy.sympify(self.ModelSpec['varspecs'][self.varmapper[i]],
+                                 locals=symbols)
+            vdef = vdef.replace(lambda e: e.is_Pow and not e.exp.is_Number,
+                                lambda e: HillPower(e.base, e.exp))
+            for j in range(numVars):
+                if variables[j] not in vdef.free_symbols:
+                    continue
+                dvdef = sympy.diff(vdef, variables[j])
+                if dvdef != 0:
+                    out.write('    J[' + str(i) + ',' + str(j) + '] = '
+                              + printer.doprint(dvdef) + '\n')
+        out.write('    return(J)\n')
+        out.write('#####################################################')
 
     
     def writeParametersToFile(self):
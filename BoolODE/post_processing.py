@@ -6,6 +6,8 @@ from pathlib import Path
 from sklearn.cluster import KMeans
 from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
+# local imports
+from BoolODE import utils
 
 def write_to_file(data,gid,filen,single=True):
     concat_data = []
@@ -41,6 +43,7 @@ def genSamples(opts):
     will then be used for other post processing steps. 
     """
     numclusters = opts['nClusters']
+    outputFormat = opts.get('output_format', 'csv')
     num_simulations = opts['num_cells']
     
     if numclusters > 1:
@@ -51,7 +54,8 @@ def genSamples(opts):
         print('sample_size should be less than num of experiments')
         sample_size = num_simulations
         
-    df = pd.read_csv(opts['outPrefix'] + '/simulations/E0.csv',index_col=0)
+    df = utils.readSimulationFile(Path(opts['outPrefix'], 'simulations', 'E0'),
+                                  outputFormat=outputFormat)
     maxtime = len(df.columns)
 
     generatedPaths = []
@@ -66,19 +70,18 @@ def genSamples(opts):
             os.makedirs(outfpath)
         # Create cell ids
         simids = np.random.choice(range(num_simulations), size=sample_size, replace=False)
-        fids = ['E'+ str(sid) + '.csv' for sid in simids]            
+        fids = ['E'+ str(sid) for sid in simids]            
         timepoints = np.random.choice(range(1,maxtime), size=sample_size)
         min_t = min(timepoints)
         max_t = max(timepoints)
         pts = [(t - min_t)/(max_t - min_t) for t in timepoints]
         cellids = ['E' + str(sid) + '_' + str(t) for sid, t in zip(simids, timepoints)] 
         # Read simulations from input dataset #psetid
-        # to build a sample
-        sample = []
-        for fid, cid in tqdm(zip(fids, cellids)):
-            df = pd.read_csv( opts['outPrefix'] + '/simulations/' + fid, index_col=0)
-            df.sort_index(inplace=True)
-            sample.append(df[cid].to_frame())
+        # to build a sample. concat collects every column in a list
+        # before concatenating, so all of them are held in memory.
+        sample = (utils.readSimulationFile(Path(opts['outPrefix'], 'simulations', fid),
+                                           outputFormat=outputFormat).sort_index()[cid].to_frame()
+                  for fid, cid in tqdm(zip(fids, cellids)))
         sampledf = pd.concat(sample,axis=1)
         sampledf.to_csv(outfpath + '/ExpressionData.csv')
         ## Read refNetwork.csv
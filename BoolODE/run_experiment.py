@@ -3,7 +3,6 @@
 __author__ = 'Amogh Jalihal'
 import os
 import sys
-import ast
 import time
 import warnings
 import numpy as np
@@ -13,9 +12,8 @@ from pathlib import Path
 from optparse import OptionParser
 from itertools import combinations
 from scipy.integrate import odeint
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 import pandas as pd
-import copy
 from importlib.machinery import SourceFileLoader
 import multiprocessing as mp
 # local imports
@@ -26,22 +24,34 @@ from BoolODE import simulator
 
 np.seterr(all='raise')
 
-def Experiment(mg, Model,
-               tspan,
-               settings,
-               icsDF,
-               writeProtein=False,
-               normalizeTrajectory=False,init_seed=0):
+## Arguments shared by every call to simulateAndSample() in a process.
+## These are set once per worker by _initWorker(), instead of being
+## pickled and sent along with each simulation.
+_STATIC = {}
+
+def _initWorker(static):
     """
-    Carry out an `in-silico` experiment. This function takes as input 
-    an ODE model defined as a python function and carries out stochastic
-    simulations. BoolODE defines a _cell_ as a single time point from 
-    a simulated time course. Thus, in order to obtain 50 single cells,
-    BoolODE carries out 50 simulations, which are stored in ./simulations/.
-    Further, if it is known that the resulting single cell dataset will
-    exhibit multiple trajectories, the user can specify  the number of clusters in
-    `nClusters`; BoolODE will then cluster the entire simulation, such that each
-    simulated trajectory possesess a cluster ID.
+    Store the arguments that are common to every simulation of an
+    Experiment() in the current process.
+
+    :param static: Dictionary of arguments constructed by buildStaticContext()
+    :type static: dict
+    """
+    global _STATIC
+    _STATIC = static
+
+def buildStaticContext(mg, Model,
+                       tspan,
+                       settings,
+                       icsDF,
+                       writeProtein=False,
+                       Jacobian=None):
+    """
+    Construct the dictionary of arguments shared by every simulation
+    of an Experiment(). These only depend on the structure of the model
+    and on the initial conditions, so that the same context can be reused
+    by successive Experiment() calls which only differ in their parameter
+    values, as in startPerturbations().
 
     :param mg: Model details obtained by instantiating an object of GenerateModel
     :type mg: BoolODE.GenerateModel
@@ -51,101 +61,165 @@ def Experiment(mg, Model,
     :type tspan: ndarray
     :param settings: The job settings dictionary
     :type settings: dict
-    :param icsDF: Dataframe specifying initial condition for simulation
+    :param icsDF: Dataframe specifying initial condition for simulation, as returned by utils.readInitialConditions()
     :type icsDF: pandas DataFrame or list of initial_configurations
     :param writeProtein: Bool specifying if the protein values should be written to file. Default = False
     :type writeProtein: bool
-    :param normalizeTrajectory: Bool specifying if the gene expression values should be scaled between 0 and 1.
-    :type normalizeTrajectory: bool 
+    :param Jacobian: Function defining the Jacobian of the ODE model, used for deterministic simulations
+    :type Jacobian: function
+    :returns:
+        - argdict: Dictionary of arguments, passed to _initWorker()
     """
-    ####################    
-    allParameters = dict(mg.ModelSpec['pars'])
-    outPrefix = str(settings['outprefix'])
-    #print(allParameters)
-    pd.DataFrame({k:[v] for k,v in allParameters.items()}).to_csv(outPrefix+"/parameters.csv")
-
-    parNames = sorted(list(allParameters.keys()))
+    parNames = sorted(list(mg.ModelSpec['pars'].keys()))
     ## Use default parameters 
-    pars = [mg.ModelSpec['pars'][k] for k in parNames]
+    pars = np.asarray([mg.ModelSpec['pars'][k] for k in parNames], dtype=np.float64)
     ####################
-    rnaIndex = [i for i in range(len(mg.varmapper.keys())) if 'x_' in mg.varmapper[i]]
+    rnaIndex = mg.rnaIndex
     revvarmapper = {v:k for k,v in mg.varmapper.items()}
-    proteinIndex = [i for i in range(len(mg.varmapper.keys())) if 'p_' in mg.varmapper[i]]
+    proteinIndex = mg.proteinIndex
 
-    y0 = [mg.ModelSpec['ics'][mg.varmapper[i]] for i in range(len(mg.varmapper.keys()))]
     ss = np.zeros(len(mg.varmapper.keys()))
     
     for i,k in mg.varmapper.items():
-        if 'x_' in k:
+        if k.startswith('x_'):
             ss[i] = 1.0
-        elif 'p_' in k:
+        elif k.startswith('p_'):
             if k.replace('p_','') in mg.proteinlist:
                 # Seting them to the threshold
                 # causes them to drop to 0 rapidly
                 # TODO: try setting to threshold < v < y_max
                 ss[i] = 20.
     multi_ss = False     
-    if type(icsDF) != list and not icsDF.empty:
-        icsspec = icsDF.loc[0]
-        genes = ast.literal_eval(icsspec['Genes'])
-        values = ast.literal_eval(icsspec['Values'])
-        icsmap = {g:v for g,v in zip(genes,values)}
-        for i,k in mg.varmapper.items():
-            for p in mg.proteinlist:
-                if p in icsmap.keys():
-                    ss[revvarmapper['p_'+p]] = icsmap[p]
-                else:
-                    ss[revvarmapper['p_'+p]] = 0.01
-            for g in mg.genelist:
-                if g in icsmap.keys():
-                    ss[revvarmapper['x_'+g]] = icsmap[g]
-                else:
-                    ss[revvarmapper['x_'+g]] = 0.01
-    else:
+    if type(icsDF) == list:
         #Multiple initial starting configuration
         multi_ss=True
-        ss = icsDF[0] # just for initialising ss
+        # One row per cell, indexed by cellid in simulateAndSample()
+        ss = np.array(icsDF, dtype=np.float64)
+    elif not icsDF.empty:
+        icsspec = icsDF.loc[0]
+        genes = icsspec['Genes']
+        values = icsspec['Values']
+        icsmap = {g:v for g,v in zip(genes,values)}
+        for p in mg.proteinlist:
+            ss[revvarmapper['p_'+p]] = icsmap.get(p, 0.01)
+        for g in mg.genelist:
+            ss[revvarmapper['x_'+g]] = icsmap.get(g, 0.01)
+
+
+    ## Variables written to the sampled cells when proteins are
+    ## specified in the species type file
+    speciesIndex = np.array([revvarmapper['p_' + p] for p in mg.proteinlist]
+                            + [revvarmapper['x_' + g] for g in mg.genelist],
+                            dtype=np.int32)
 
-            
-    if len(mg.proteinlist) == 0:
-        result = pd.DataFrame(index=pd.Index([mg.varmapper[i] for i in rnaIndex]))
-    else:
-        speciesoi = [revvarmapper['p_' + p] for p in proteinlist]
-        speciesoi.extend([revvarmapper['x_' + g] for g in mg.genelist])
-        result = pd.DataFrame(index=pd.Index([mg.varmapper[i] for i in speciesoi]))
-        
     # Index of every possible time point. Sample from this list
     startat = 0
     timeIndex = [i for i in range(startat, len(tspan))]        
+    # Time points written to file, excluding the initial condition
+    tps = np.arange(1, len(tspan), dtype=np.int32)
 
     ## Construct dictionary of arguments to be passed
     ## to simulateAndSample(), done in parallel
-    outPrefix = str(settings['outprefix'])
     argdict = {}
     argdict['mg'] = mg
-    argdict['allParameters'] = allParameters
     argdict['parNames'] = parNames
     argdict['Model'] = Model
+    argdict['Jacobian'] = Jacobian
     argdict['tspan'] = tspan
     argdict['varmapper'] = mg.varmapper
     argdict['timeIndex'] = timeIndex
+    argdict['tps'] = tps
     argdict['genelist'] = mg.genelist
     argdict['proteinlist'] = mg.proteinlist
     argdict['writeProtein'] = writeProtein
-    argdict['outPrefix'] = outPrefix
     argdict['sampleCells'] = settings['sample_cells'] # TODO consider removing this option
     argdict['pars'] = pars
     argdict['ss'] = ss
     argdict['ModelSpec'] = mg.ModelSpec
     argdict['rnaIndex'] = rnaIndex
     argdict['proteinIndex'] = proteinIndex
+    argdict['speciesIndex'] = speciesIndex
     argdict['revvarmapper'] = revvarmapper
     argdict['x_max'] = mg.kineticParameterDefaults['x_max']
+    argdict['multi_ss'] = multi_ss
+    argdict['writeCSV'] = settings['write_csv']
+    argdict['isStochastic'] = not settings['deterministic']
+    argdict['outputFormat'] = settings['output_format']
     if multi_ss:
         argdict['get_prot'] = False
     else :
         argdict['get_prot'] = True
+    return argdict
+
+def Experiment(mg, Model,
+               tspan,
+               settings,
+               icsDF,
+               writeProtein=False,
+               normalizeTrajectory=False,init_seed=0,
+               Jacobian=None,
+               staticCtx=None,
+               pars=None,
+               pool=None):
+    """
+    Carry out an `in-silico` experiment. This function takes as input 
+    an ODE model defined as a python function and carries out stochastic
+    simulations. BoolODE defines a _cell_ as a single time point from 
+    a simulated time course. Thus, in order to obtain 50 single cells,
+    BoolODE carries out 50 simulations, which are stored in ./simulations/.
+    Further, if it is known that the resulting single cell dataset will
+    exhibit multiple trajectories, the user can specify  the number of clusters in
+    `nClusters`; BoolODE will then cluster the entire simulation, such that each
+    simulated trajectory possesess a cluster ID.
 
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :param Model: Function defining ODE model
+    :type Model: function
+    :param tspan: Array of time points
+    :type tspan: ndarray
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :param icsDF: Dataframe specifying initial condition for simulation
+    :type icsDF: pandas DataFrame or list of initial_configurations
+    :param writeProtein: Bool specifying if the protein values should be written to file. Default = False
+    :type writeProtein: bool
+    :param normalizeTrajectory: Bool specifying if the gene expression values should be scaled between 0 and 1.
+    :type normalizeTrajectory: bool 
+    :param Jacobian: Function defining the Jacobian of the ODE model, used for deterministic simulations
+    :type Jacobian: function
+    :param staticCtx: Arguments shared by all simulations, constructed by buildStaticContext(). Built from the other arguments if not specified.
+    :type staticCtx: dict
+    :param pars: Parameter values, in the order of staticCtx['parNames']. Uses the parameters of the model if not specified.
+    :type pars: ndarray
+    :param pool: Pool of workers initialized with staticCtx, used if doParallel is True. A new pool is created if not specified.
+    :type pool: multiprocessing.Pool
+    """
+    ####################    
+    if staticCtx is None:
+        staticCtx = buildStaticContext(mg, Model, tspan, settings, icsDF,
+                                       writeProtein=writeProtein,
+                                       Jacobian=Jacobian)
+    if pars is None:
+        pars = staticCtx['pars']
+    parNames = staticCtx['parNames']
+    timeIndex = staticCtx['timeIndex']
+    tps = staticCtx['tps']
+    outPrefix = str(settings['outprefix'])
+    ## Creates the output directory of a perturbation, along with
+    ## the directory holding the simulations
+    simDir = Path(outPrefix) / 'simulations'
+    simDir.mkdir(parents=True, exist_ok=True)
+    parIndex = {k:i for i,k in enumerate(parNames)}
+    pd.DataFrame({k:[pars[parIndex[k]]] for k in mg.ModelSpec['pars'].keys()})\
+      .to_csv(outPrefix+"/parameters.csv")
+
+    ## Arguments which change from one Experiment() to the next,
+    ## sent along with each simulation
+    run = {}
+    run['pars'] = pars
+    run['simDir'] = simDir
+    run['header'] = None
     if settings['sample_cells']:
         # pre-define the time points from which a cell will be sampled
         # per simulation
@@ -154,73 +228,87 @@ def Experiment(mg, Model,
                   for cellid, time in\
                   zip(range(settings['num_cells']), sampleAt)]
         
-        argdict['header'] = header
-    else:
-        # initialize dictionary to hold raveled values, used to cluster
-        # This will be useful later.
-        groupedDict = {}         
-
-    simfilepath = Path(outPrefix, './simulations/')
-    if not os.path.exists(simfilepath):
-        print(simfilepath, "does not exist, creating it...")
-        os.makedirs(simfilepath)
+        run['header'] = header
+
     print('Starting simulations')
     start = time.time()
 
     states = []
 
-    if settings['doParallel']:
-        with mp.Pool() as pool:
-            jobs = []
-            for cellid in range(settings['num_cells']):
-
-                if multi_ss:
-                    argdict["ss"] = icsDF[cellid]
-
-                cell_args = dict(argdict, seed=cellid + init_seed, cellid=cellid)
-                job = pool.apply_async(simulateAndSample, args=(cell_args,))
-                jobs.append(job)
-                
-            states = [job.get() for job in jobs]
+    if settings['doBatch']:
+        _initWorker(staticCtx)
+        states = simulateBatch([cellid for cellid in range(settings['num_cells'])],
+                               [cellid + init_seed for cellid in range(settings['num_cells'])],
+                               run)
+    elif settings['doParallel']:
+        tasks = [(cellid, cellid + init_seed, run) for cellid in range(settings['num_cells'])]
+        # Send several simulations to a worker at once, while keeping
+        # enough chunks to balance the load between workers
+        chunksize = max(1, settings['num_cells']//(8*mp.cpu_count()))
+        ownPool = pool is None
+        if ownPool:
+            pool = mp.Pool(initializer=_initWorker, initargs=(staticCtx,))
+        try:
+            for state in tqdm(pool.imap_unordered(simulateAndSample, tasks,
+                                                  chunksize=chunksize),
+                              total=len(tasks)):
+                states.append(state)
+        finally:
+            if ownPool:
+                pool.terminate()
+        # Results arrive in order of completion
+        states.sort(key=lambda state: state[3])
     else:
+        _initWorker(staticCtx)
         for cellid in tqdm(range(settings['num_cells'])):
-            argdict['seed'] = cellid + init_seed
-            argdict['cellid'] = cellid
-            if multi_ss:
-                argdict["ss"] = icsDF[cellid]
-
-            states.append(simulateAndSample(argdict))
+            states.append(simulateAndSample((cellid, cellid + init_seed, run)))
 
     # extract mean time and final_states
     final_states=[]
-    avg_traj = []
     n_traj = len(states)
-    for f,whole_t in states:
+    avg_traj = np.zeros(states[0][1][::2,:].shape, dtype=np.float32)
+    for f,whole_t,subset,cellid in states:
         final_states.append(f)
-        if len(avg_traj) != 0 :
-            avg_traj += whole_t[::2,:] / n_traj
-        else:
-            avg_traj  = whole_t[::2,:].copy() / n_traj
+        avg_traj += whole_t[::2,:]
+    avg_traj /= n_traj
 
 
     print("Simulations took %0.3f s"%(time.time() - start))
-    frames = []
-    print('starting to concat files')
+    print('starting to concat simulations')
     start = time.time()
 
-    for cellid in tqdm(range(settings['num_cells'])):
-        if settings['sample_cells']:
-            df = pd.read_csv(outPrefix + '/simulations/E'+str(cellid) + '-cell.csv',index_col=0)
-            df = df.sort_index()                
-        else:
-            df = pd.read_csv(outPrefix + '/simulations/E'+str(cellid) + '.csv',index_col=0)
-            df = df.sort_index()
-            groupedDict['E' + str(cellid)] = df.values.ravel()
-        frames.append(df.T)
+    if settings['sample_cells']:
+        # concat still collects all the sampled cells in a
+        # list before concatenating them
+        frames = (utils.sampleCellFromTraj(cellid,
+                                           tspan,
+                                           whole_t,
+                                           mg.varmapper, timeIndex,
+                                           mg.genelist, mg.proteinlist,
+                                           header,
+                                           writeProtein=writeProtein,
+                                           speciesIndex=staticCtx['speciesIndex']).sort_index(axis=1)
+                  for f,whole_t,subset,cellid in states)
+        result = pd.concat(frames,axis=0)
+        result = result.T
+    else:
+        # Genes are sorted by name, as in the simulation files
+        geneOrder = np.argsort(mg.genelist)
+        columns = []
+        # Raveled trajectories, one row per cell, used to cluster
+        grouped = np.empty((len(states), states[0][2].size), dtype=np.float32)
+        groupedNames = []
+        for row, (f,whole_t,subset,cellid) in enumerate(states):
+            grouped[row] = subset[geneOrder].ravel()
+            groupedNames.append('E' + str(cellid))
+            columns.extend(['E' + str(cellid) + '_' + str(i) for i in tps])
+        result = pd.DataFrame(np.concatenate([subset[geneOrder]
+                                              for f,whole_t,subset,cellid in states],
+                                             axis=1),
+                              index=pd.Index([mg.genelist[i] for i in geneOrder]),
+                              columns=columns)
     stop = time.time()
-    print("Concating files took %.2f s" %(stop-start))
-    result = pd.concat(frames,axis=0)
-    result = result.T
+    print("Concating simulations took %.2f s" %(stop-start))
     indices = result.index
     newindices = [i.replace('x_','') for i in indices]
     result.index = pd.Index(newindices)
@@ -229,15 +317,15 @@ def Experiment(mg, Model,
         ## Carry out k-means clustering to identify which
         ## trajectory a simulation belongs to
         print('Starting k-means clustering')
-        groupedDF = pd.DataFrame.from_dict(groupedDict)
         print('Clustering simulations...')
         start = time.time()            
         # Find clusters in the experiments
-        clusterLabels= KMeans(n_clusters=settings['nClusters'],
-                              n_jobs=8).fit(groupedDF.T.values).labels_
+        clusterLabels= MiniBatchKMeans(n_clusters=settings['nClusters'],
+                                       batch_size=1024,
+                                       n_init=3).fit(grouped).labels_
         print('Clustering took %0.3fs' % (time.time() - start))
         clusterDF = pd.DataFrame(data=clusterLabels, index =\
-                                 groupedDF.columns, columns=['cl'])
+                                 pd.Index(groupedNames), columns=['cl'])
         clusterDF.to_csv(outPrefix + '/ClusterIds.csv')
     else:
         print('Requested nClusters=1, not performing k-means clustering')
@@ -264,7 +352,7 @@ def startRun(settings):
     ## are left empty
     parameterInputsDF = utils.checkValidInputPath(settings['parameter_inputs_path'])
     parameterSetDF = utils.checkValidInputPath(settings['parameter_set'])
-    icsDF = utils.checkValidInputPath(settings['icsPath'])
+    icsDF = utils.readInitialConditions(settings['icsPath'])
     interactionStrengthDF = utils.checkValidInputPath(settings['interaction_strengths'])
 
     speciesTypeDF = utils.checkValidInputPath(settings['species_type'])
@@ -288,6 +376,15 @@ def startRun(settings):
     # Load the ODE model file
     print("Model",mg.path_to_ode_model.as_posix())
     model = SourceFileLoader("model", mg.path_to_ode_model.as_posix()).load_module()
+    # Replace the python ODE function by its compiled version, which is
+    # then shared by every call to simulateAndSample()
+    model.Model = simulator.compileModel(model.Model,
+                                         len(mg.varmapper.keys()),
+                                         len(mg.ModelSpec['pars'].keys()))
+    # The Jacobian is only written for deterministic simulations of
+    # hill models, when sympy is installed. It is not compiled.
+    if not hasattr(model, 'Jacobian'):
+        model.Jacobian = None
 
     ## Function call - do the in silico experiment
     resultDF,final_states,avg_traj = Experiment(mg, model.Model,
@@ -295,7 +392,8 @@ def startRun(settings):
                           settings,
                           icsDF,
                           writeProtein=settings['writeProtein'],
-                          normalizeTrajectory=settings['normalizeTrajectory'])
+                          normalizeTrajectory=settings['normalizeTrajectory'],
+                          Jacobian=model.Jacobian)
     
     # Write simulation output. Creates ground truth files.
     print('Generating input files for pipline...')
@@ -323,7 +421,7 @@ def startPerturbations(settings,previous_run={},perturbation_level=2,single=True
 
 
     mg = previous_run["mg"]
-    gid = [int(n.replace("x_g","")) for i,n in mg.varmapper.items() if 'x_' in n] # list tof gene_id
+    gid = [int(mg.varmapper[i].replace("x_g","")) for i in mg.rnaIndex] # list tof gene_id
     print("Genes id",gid)
 
 
@@ -336,15 +434,21 @@ def startPerturbations(settings,previous_run={},perturbation_level=2,single=True
                 list_perturbations.append([p1,p2])
 
     print("list of perturbation", list_perturbations)
-    allParameters = dict(mg.ModelSpec['pars'])
-    parNames = sorted(list(allParameters.keys()))
+    ## Every perturbation shares the model and the initial conditions,
+    ## only the parameter values change from one Experiment() to the next
+    staticCtx = buildStaticContext(mg,
+                                   previous_run["model"].Model,
+                                   previous_run["tspan"],
+                                   settings,
+                                   previous_run["final_states"],
+                                   writeProtein=settings['writeProtein'],
+                                   Jacobian=previous_run["model"].Jacobian)
+    parNames = staticCtx['parNames']
+    parIndex = {k:i for i,k in enumerate(parNames)}
     ## Use default parameters 
-    pars = [mg.ModelSpec['pars'][k] for k in parNames]
-
+    init_pars = staticCtx['pars']
 
-    #Initial parameters 
-    init_pars = copy.deepcopy(pars)
-    init_out_prefix = copy.deepcopy(settings['outprefix'])
+    init_out_prefix = settings['outprefix']
     #print(len(previous_run["final_states"]))
     if single:
         lab = [0]
@@ -353,27 +457,38 @@ def startPerturbations(settings,previous_run={},perturbation_level=2,single=True
     final_states={str(lab):previous_run["final_states"]}
     avg_trajs={}
     #print(mg.ModelSpec['pars'])
-    for perturbations in list_perturbations:
-        for gene in perturbations:
-            for par_name in parNames:
-                if par_name == "m_g%i"%gene:
-                    print("Init",mg.ModelSpec['pars'][par_name] )
-                    mg.ModelSpec['pars'][par_name] = apply_perturbation(mg.ModelSpec['pars'][par_name]) 
-                    print("After",mg.ModelSpec['pars'][par_name] )
-        
-        settings['outprefix'] = str(init_out_prefix) + "/Perturbation_" + "_".join(map(str,perturbations))
-
-        resultDF,final_state,avg_traj = Experiment(mg, 
-                              previous_run["model"].Model,
-                              previous_run["tspan"],
-                              settings,
-                              previous_run["final_states"],
-                              writeProtein=settings['writeProtein'],
-                               normalizeTrajectory=settings['normalizeTrajectory'],init_seed=1)
-        final_states[str(perturbations)]=final_state
-        avg_trajs[ str(init_out_prefix) +"/dynamics/Perturbation_" + "_".join(map(str,perturbations))+".png"] = avg_traj
-        for i,k in enumerate(parNames):
-            mg.ModelSpec['pars'][k] = init_pars[i]
+    ## The workers are started once, and reused by every perturbation
+    pool = None
+    if settings['doParallel'] and not settings['doBatch']:
+        pool = mp.Pool(initializer=_initWorker, initargs=(staticCtx,))
+    try:
+        for perturbations in list_perturbations:
+            pars = init_pars.copy()
+            for gene in perturbations:
+                par_name = "m_g%i"%gene
+                if par_name in parIndex:
+                    print("Init",pars[parIndex[par_name]] )
+                    pars[parIndex[par_name]] = apply_perturbation(pars[parIndex[par_name]])
+                    print("After",pars[parIndex[par_name]] )
+
+            settings['outprefix'] = str(init_out_prefix) + "/Perturbation_" + "_".join(map(str,perturbations))
+
+            resultDF,final_state,avg_traj = Experiment(mg, 
+                                  previous_run["model"].Model,
+                                  previous_run["tspan"],
+                                  settings,
+                                  previous_run["final_states"],
+                                  writeProtein=settings['writeProtein'],
+                                  normalizeTrajectory=settings['normalizeTrajectory'],init_seed=1,
+                                  Jacobian=previous_run["model"].Jacobian,
+                                  staticCtx=staticCtx,
+                                  pars=pars,
+                                  pool=pool)
+            final_states[str(perturbations)]=final_state
+            avg_trajs[ str(init_out_prefix) +"/dynamics/Perturbation_" + "_".join(map(str,perturbations))+".png"] = avg_traj
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 
     settings['outprefix']  = init_out_prefix
@@ -381,24 +496,26 @@ def startPerturbations(settings,previous_run={},perturbation_level=2,single=True
     return {"final_states":final_states,"gid":gid,"avg_trajs":avg_trajs}
 
 
-def simulateAndSample(argdict):
+def simulateAndSample(task):
     """
     Handles parallelization of ODE simulations.
     Calls the simulator with simulation settings.
+    The arguments common to all simulations are read from
+    _STATIC, which is set by _initWorker().
+
+    :param task: Index of the simulated cell, seed to initialize random number generator, and arguments specific to the Experiment()
+    :type task: tuple
     """
+    cellid, seed, run = task
+    argdict = _STATIC
     mg = argdict['mg']
-    allParameters = argdict['allParameters']
-    parNames = argdict['parNames']
     Model = argdict['Model']
+    Jacobian = argdict['Jacobian']
     tspan = argdict['tspan']
     varmapper = argdict['varmapper']
-    timeIndex = argdict['timeIndex']
     genelist = argdict['genelist']
     proteinlist = argdict['proteinlist']
-    writeProtein=argdict['writeProtein']
-    cellid = argdict['cellid']
-    outPrefix = argdict['outPrefix']
-    sampleCells = argdict['sampleCells']
+    writeCSV = argdict['writeCSV']
     ss = argdict['ss']
     ModelSpec = argdict['ModelSpec']
     rnaIndex = argdict['rnaIndex']
@@ -406,34 +523,19 @@ def simulateAndSample(argdict):
     genelist = argdict['genelist']
     proteinlist = argdict['proteinlist']
     revvarmapper = argdict['revvarmapper']
-    seed = argdict['seed']
-    pars = argdict['pars']
+    pars = run['pars']
     x_max = argdict['x_max']
     get_prot = argdict["get_prot"]
-    
-    # Retained for debugging
-    isStochastic = True
-    
-    if sampleCells:
-        header = argdict['header']
-        
-    pars = {}
-    for k, v in allParameters.items():
-        pars[k] = v
-    #print(pars)
-    #print(parNames)
-    pars = [pars[k] for k in parNames]
+    if argdict['multi_ss']:
+        ss = ss[cellid]
+    isStochastic = argdict['isStochastic']
     
     ## Boolean to check if a simulation is going to a
     ## 0 steady state, with all genes/proteins dying out
     retry = True
     trys = 0
     ## timepoints
-    tps = [i for i in range(1,len(tspan))]
-    ## gene ids
-    gid = [i for i,n in varmapper.items() if 'x_' in n]
-    alls = [i for i,n in varmapper.items() ]
-    outPrefix = outPrefix + '/simulations/'
+    tps = argdict['tps']
     while retry:
         seed += 1000
         #print("Init out",ss)
@@ -446,48 +548,143 @@ def simulateAndSample(argdict):
             y0_exp = ss
         #print(y0_exp)
         #raise
-        P = simulator.simulateModel(Model, y0_exp, pars, isStochastic, tspan, seed)
-        P = P.T
+        P = simulator.simulateModel(Model, y0_exp, pars, isStochastic, tspan, seed,
+                                    Jacobian=Jacobian)
+        ## The simulation is integrated in double precision, the
+        ## trajectory is only stored in single precision
+        P = P.T.astype(np.float32)
         retry = False
         ## Extract Time points
-        subset = P[gid,:][:,tps]
-        df = pd.DataFrame(subset,
-                          index=pd.Index(genelist),
-                          columns = ['E' + str(cellid) +'_' +str(i)\
-                                     for i in tps])
-        df.to_csv(outPrefix + 'E' + str(cellid) + '.csv')        
+        subset = P[np.ix_(rnaIndex, tps)]
         ## Heuristic:
         ## If the largest value of a protein achieved in a simulation is
         ## less than 10% of the y_max, drop the simulation.
         ## This check stems from the observation that in some simulations,
         ## all genes go to the 0 steady state in some rare simulations.
-        dfmax = df.max()
-        for col in df.columns:
-            colmax = df[col].max()
-            if colmax < 0.1*x_max:
-                retry= True
-                break
+        ## A deterministic simulation would only be repeated.
+        if isStochastic and subset.max(axis=0).min() < 0.1*x_max:
+            retry = True
         
-        if sampleCells:
-            ## Write a single cell to file
-            ## These samples allow for quickly and
-            ## reproducibly testing the output.
-            sampledf = utils.sampleCellFromTraj(cellid,
-                                          tspan, 
-                                          P,
-                                          varmapper, timeIndex,
-                                          genelist, proteinlist,
-                                          header,
-                                          writeProtein=writeProtein)
-            sampledf = sampledf.T
-            sampledf.to_csv(outPrefix + 'E' + str(cellid) + '-cell.csv')            
-            
         trys += 1
-        # write to file
-        df.to_csv(outPrefix + 'E' + str(cellid) + '.csv')
-        
         if trys > 1:
             print('try', trys)
 
+    # write the accepted simulation to file
+    if writeCSV:
+        writeSimulation(cellid, P, subset, run)
 
-    return P[alls,:][:,tps[-1]],P[alls,:][:,:]
+    return P[:,tps[-1]],P,subset,cellid
+
+
+def simulateBatch(cellids, seeds, run):
+    """
+    Simulates all cells in lockstep, using simulator.eulersdeBatch().
+    This avoids the overhead of one call to the integrator per cell.
+    Cells which go to the 0 steady state are simulated again, as in
+    simulateAndSample(). The arguments common to all simulations are
+    read from _STATIC, which is set by _initWorker().
+
+    :param cellids: Indices of the simulated cells
+    :type cellids: list
+    :param seeds: Seed to initialize random number generator, for each cell
+    :type seeds: list
+    :param run: Arguments specific to the Experiment(), constructed by Experiment()
+    :type run: dict
+    :returns:
+        - states: List of the values returned by simulateAndSample(), for each cell
+    """
+    argdict = _STATIC
+    # The compiled model only accepts a single state vector
+    Model = getattr(argdict['Model'], 'py_func', argdict['Model'])
+    tspan = argdict['tspan']
+    varmapper = argdict['varmapper']
+    genelist = argdict['genelist']
+    proteinlist = argdict['proteinlist']
+    writeCSV = argdict['writeCSV']
+    ss = argdict['ss']
+    ModelSpec = argdict['ModelSpec']
+    rnaIndex = argdict['rnaIndex']
+    proteinIndex = argdict['proteinIndex']
+    revvarmapper = argdict['revvarmapper']
+    pars = run['pars']
+    x_max = argdict['x_max']
+    get_prot = argdict["get_prot"]
+
+    trys = 0
+    ## timepoints
+    tps = argdict['tps']
+    states = {}
+    cellids = list(cellids)
+    seeds = list(seeds)
+    while len(cellids) > 0:
+        seeds = [seed + 1000 for seed in seeds]
+        if get_prot:
+            y0_exp = simulator.getInitialCondition(ss, ModelSpec, rnaIndex, proteinIndex,
+                                                   genelist, proteinlist,
+                                                   varmapper,revvarmapper)
+            Y0 = np.repeat(np.array(y0_exp)[:,np.newaxis], len(cellids), axis=1)
+        else:
+            Y0 = ss[cellids].T
+        Y = simulator.eulersdeBatch(Model, simulator.noise, Y0, tspan, pars, seeds)
+        trys += 1
+        if trys > 1:
+            print('try', trys)
+        retryids = []
+        retryseeds = []
+        for i, (cellid, seed) in enumerate(zip(cellids, seeds)):
+            P = Y[:,:,i].T.astype(np.float32)
+            ## Extract Time points
+            subset = P[np.ix_(rnaIndex, tps)]
+            ## Heuristic: see simulateAndSample()
+            if subset.max(axis=0).min() < 0.1*x_max:
+                retryids.append(cellid)
+                retryseeds.append(seed)
+                continue
+            if writeCSV:
+                writeSimulation(cellid, P, subset, run)
+            states[cellid] = (P[:,tps[-1]],P,subset,cellid)
+        cellids = retryids
+        seeds = retryseeds
+    return [states[cellid] for cellid in sorted(states.keys())]
+
+def writeSimulation(cellid, P, subset, run):
+    """
+    Writes the simulated time course of a cell to /simulations/E[cellid],
+    in the format specified by output_format, and the sampled cell to /simulations/E[cellid]-cell.csv if sampleCells
+    is True. The arguments common to all simulations are read from
+    _STATIC, which is set by _initWorker().
+
+    :param cellid: Index of the simulated cell
+    :type cellid: int
+    :param P: Time course of all variables in the model
+    :type P: ndarray
+    :param subset: Time course of the genes, excluding the initial time point
+    :type subset: ndarray
+    :param run: Arguments specific to the Experiment(), constructed by Experiment()
+    :type run: dict
+    """
+    argdict = _STATIC
+    tspan = argdict['tspan']
+    genelist = argdict['genelist']
+    simDir = run['simDir']
+    tps = argdict['tps']
+    if argdict['sampleCells']:
+        ## Write a single cell to file
+        ## These samples allow for quickly and
+        ## reproducibly testing the output.
+        sampledf = utils.sampleCellFromTraj(cellid,
+                                      tspan, 
+                                      P,
+                                      argdict['varmapper'], argdict['timeIndex'],
+                                      genelist, argdict['proteinlist'],
+                                      run['header'],
+                                      writeProtein=argdict['writeProtein'],
+                                      speciesIndex=argdict['speciesIndex'])
+        sampledf = sampledf.T
+        sampledf.to_csv(simDir / ('E' + str(cellid) + '-cell.csv'))            
+    df = pd.DataFrame(subset,
+                      index=pd.Index(genelist),
+                      columns = ['E' + str(cellid) +'_' +str(i)\
+                                 for i in tps])
+    utils.writeSimulationFile(df, simDir / ('E' + str(cellid)),
+                              outputFormat=argdict['outputFormat'])
@@ -1,4 +1,9 @@
 import numpy as np
+from scipy.integrate import solve_ivp
+try:
+    import numba
+except ImportError:
+    numba = None
 
 def noise(x,t):
     # Controls noise proportional to
@@ -47,7 +52,7 @@ def eulersde(f,G,y0,tspan,pars,seed=0.,dW=None):
         # pre-generate Wiener increments (for d independent Wiener processes):
         dW = deltaW(N, d, h, seed=seed)
     y[0] = y0
-    currtime = 0
+    currtime = 0.
     n = 0
    
 
@@ -68,10 +73,82 @@ def eulersde(f,G,y0,tspan,pars,seed=0.,dW=None):
      
     return y
 
-def simulateModel(Model, y0, parameters,isStochastic, tspan,seed):
-    """Call numerical integration functions, either odeint() from Scipy,
+def eulersdeBatch(f,G,Y0,tspan,pars,seeds):
+    """
+    Vectorized version of eulersde(), which simulates one trajectory per
+    column of Y0 in lockstep. f and G are evaluated once per time step
+    on the array of all trajectories, so they should only use elementwise
+    numpy operations. The Wiener increments of each trajectory are
+    generated using deltaW() with the corresponding seed, so each
+    trajectory is identical to the one obtained by eulersde().
+
+    :param f: function defining ODE model. Should take array of current states, current time, and list of parameter values as arguments.
+    :type f: function
+    :param Y0: Array of initial values, with shape (number of variables, number of trajectories)
+    :type Y0: ndarray
+    :param tspan: Array of timepoints to simulate
+    :type tspan: ndarray
+    :param pars: List of parameter values
+    :type pars: list
+    :param seeds: Seed to initialize random number generator, for each trajectory
+    :type seeds: list
+    :returns:
+        - y: Array containing the time courses of state variables, with shape (time points, variables, trajectories)
+    """
+    N = len(tspan)
+    h = (tspan[N-1] - tspan[0])/(N - 1)
+    maxtime = tspan[-1]
+    # allocate space for result
+    d, C = np.shape(Y0)
+    y = np.zeros((N+1, d, C))
+    # pre-generate Wiener increments for each trajectory
+    dW = np.stack([deltaW(N, d, h, seed=seed) for seed in seeds], axis=2)
+    y[0] = Y0
+    currtime = 0.
+    n = 0
+    # Underflows are expected in some, but not all trajectories
+    with np.errstate(under='ignore'):
+        while currtime < maxtime:
+            tn = currtime
+            yn = y[n]
+            ynext = yn + f(yn, tn, pars)*h + np.multiply(G(yn, tn), dW[n])
+            # Ensure positive terms
+            y[n+1] = np.where(ynext < 0, yn, ynext)
+            currtime += h
+            n += 1
+    return y
+
+def compileModel(Model, numVars, numPars):
+    """JIT compile the ODE model using numba, if it is installed.
+    The compiled function is called once with dummy arguments so that
+    compilation happens here, and not inside each simulation. If numba
+    is unavailable, or fails to compile the model, the python function
+    is returned unchanged.
+
+    :param Model: Function defining ODE model
+    :type Model: function
+    :param numVars: Number of state variables in the model
+    :type numVars: int
+    :param numPars: Number of parameters in the model
+    :type numPars: int
+    :returns:
+        - Model: Compiled function, or the original function
+    """
+    if numba is None:
+        return(Model)
+    try:
+        jitModel = numba.njit(fastmath=True)(Model)
+        jitModel(np.ones(numVars), 0., np.ones(numPars))
+    except Exception as e:
+        print("numba could not compile the model, using python instead:", e)
+        return(Model)
+    return(jitModel)
+
+def simulateModel(Model, y0, parameters,isStochastic, tspan,seed,Jacobian=None):
+    """Call numerical integration functions, either solve_ivp() from Scipy,
     or simulator.eulersde() defined in simulator.py. By default, stochastic simulations are
-    carried out using simulator.eulersde.
+    carried out using simulator.eulersde. Deterministic simulations use the
+    stiff LSODA solver, with the analytical Jacobian if it is available.
 
     :param Model: Function defining ODE model
     :type Model: function
@@ -85,13 +162,22 @@ def simulateModel(Model, y0, parameters,isStochastic, tspan,seed):
     :type tspan: ndarray
     :param seed: Seed to initialize random number generator
     :type seed: float
+    :param Jacobian: Function returning the Jacobian of the ODE model. Default = None
+    :type Jacobian: function
     :returns: 
         - P: Time course from numerical integration
     :rtype: ndarray
 
     """
     if not isStochastic:
-        P = odeint(Model,y0,tspan,args=(parameters,))
+        jac = None
+        if Jacobian is not None:
+            jac = lambda t, y: Jacobian(y, t, parameters)
+        sol = solve_ivp(lambda t, y: Model(y, t, parameters),
+                        (tspan[0], tspan[-1]), y0,
+                        method='LSODA', jac=jac,
+                        t_eval=tspan, rtol=1e-6)
+        P = sol.y.T
     else:
         P = eulersde(Model,noise,y0,tspan,parameters,seed=seed)
     return(P)
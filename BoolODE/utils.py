@@ -1,5 +1,6 @@
 import os
 import sys
+import ast
 import yaml
 import numpy as np
 import pandas as pd
@@ -280,7 +281,7 @@ def sampleTimeSeries(num_timepoints, expnum,\
     """
     revvarmapper = {v:k for k,v in varmapper.items()}
     experimentTimePoints = [h for h in header if 'E' + str(expnum) in h]
-    rnaIndex = [i for i in range(len(varmapper.keys())) if 'x_' in varmapper[i]]
+    rnaIndex = [i for i in range(len(varmapper.keys())) if varmapper[i].startswith('x_')]
     sampleDict = {}
     
     if writeProtein:
@@ -296,7 +297,6 @@ def sampleTimeSeries(num_timepoints, expnum,\
         else:
             speciesoi = [revvarmapper['p_' + p] for p in proteinlist]
             speciesoi.extend([revvarmapper['x_' + g] for g in genelist])
-            result = pd.DataFrame(index=pd.Index([varmapper[i] for i in speciesoi]))
 
             for si in speciesoi:
                 sampleDict[varmapper[si]] = {h:P[si][ti]\
@@ -310,13 +310,17 @@ def sampleCellFromTraj(cellid,
                        P,
                        varmapper,sampleAt,
                        genelist, proteinlist,
-                       header,writeProtein=False):
+                       header,writeProtein=False,
+                       speciesIndex=None):
     """
     Returns pandas DataFrame with columns corresponding to 
     time points and rows corresponding to genes
+
+    :param speciesIndex: Indices of the proteins followed by the genes, used if proteinlist is not empty. Computed from varmapper if not specified.
+    :type speciesIndex: ndarray
     """
     revvarmapper = {v:k for k,v in varmapper.items()}
-    rnaIndex = [i for i in range(len(varmapper.keys())) if 'x_' in varmapper[i]]
+    rnaIndex = [i for i in range(len(varmapper.keys())) if varmapper[i].startswith('x_')]
     sampleDict = {}
     timepoint = int(header[cellid].split('_')[1])
     if writeProtein:
@@ -329,17 +333,60 @@ def sampleCellFromTraj(cellid,
             for ri in rnaIndex:
                 sampleDict[varmapper[ri]] = {header[cellid]: P[ri][timepoint]}
         else:
-            speciesoi = [revvarmapper['p_' + p] for p in proteinlist]
-            speciesoi.extend([revvarmapper['x_' + g] for g in genelist])
-            result = pd.DataFrame(index=pd.Index([varmapper[i] for i\
-                                                  in speciesoi]))
-            for si in speciesoi:
-                sampleDict[varmapper[si]] = {header[cellid]: P[ri][timepoint]}
+            if speciesIndex is None:
+                speciesIndex = [revvarmapper['p_' + p] for p in proteinlist]
+                speciesIndex.extend([revvarmapper['x_' + g] for g in genelist])
+            for si in speciesIndex:
+                sampleDict[varmapper[si]] = {header[cellid]: P[si][timepoint]}
 
     sampleDF = pd.DataFrame(sampleDict)
     return(sampleDF)
 
 
+def writeSimulationFile(df, path, outputFormat='csv'):
+    """
+    Writes a simulated time course to path, using the file format
+    specified by outputFormat. The extension of the format is appended
+    to path. Parquet and feather files require pyarrow.
+
+    :param df: Simulated time course, rows are genes, columns are time points
+    :type df: pandas DataFrame
+    :param path: Path to the file, without extension
+    :type path: pathlib.Path
+    :param outputFormat: One of 'csv', 'parquet' or 'feather'. Default = 'csv'
+    :type outputFormat: str
+    """
+    path = Path(str(path) + '.' + outputFormat)
+    if outputFormat == 'parquet':
+        df.to_parquet(path, compression='zstd')
+    elif outputFormat == 'feather':
+        # feather files do not store the index
+        df.reset_index().to_feather(path)
+    else:
+        df.to_csv(path)
+
+def readSimulationFile(path, outputFormat='csv'):
+    """
+    Reads a simulated time course written by writeSimulationFile()
+
+    :param path: Path to the file, without extension
+    :type path: pathlib.Path
+    :param outputFormat: One of 'csv', 'parquet' or 'feather'. Default = 'csv'
+    :type outputFormat: str
+    :returns:
+        - df: Simulated time course, rows are genes, columns are time points
+    """
+    path = Path(str(path) + '.' + outputFormat)
+    if outputFormat == 'parquet':
+        df = pd.read_parquet(path)
+    elif outputFormat == 'feather':
+        df = pd.read_feather(path)
+        df = df.set_index(df.columns[0])
+        df.index.name = None
+    else:
+        df = pd.read_csv(path, index_col=0)
+    return(df)
+
 def checkValidInputPath(path):
     """
     Returns dataframe of file at path.
@@ -351,6 +398,19 @@ def checkValidInputPath(path):
     return(df)
 
 
+def readInitialConditions(path):
+    """
+    Returns dataframe of the initial conditions file at path,
+    with the lists in the Genes and Values columns already parsed.
+    If path is not valid, returns empty dataframe.
+    """
+    df = checkValidInputPath(path)
+    if not df.empty:
+        df['Genes'] = df['Genes'].apply(ast.literal_eval)
+        df['Values'] = df['Values'].apply(ast.literal_eval)
+    return(df)
+
+
 def checkValidModelDefinitionPath(path, name):
     # Check if model defintion file exists
     if not os.path.isfile(path):